@@ -16,31 +16,48 @@ def enter_presionado():
     # Revisa si ENTER fue presionado sin bloquear
     return select.select([sys.stdin], [], [], 0) == ([sys.stdin], [], [])
 
-def grabar_audio(nombre="temp.wav", fs=16000):
+def grabar_audio(nombre="temp.wav", fs=16000, max_segundos=600):
     esperar_enter()
 
-    recording = sd.InputStream(samplerate=fs, channels=1, dtype='int16')
-    audio_data = []
+    # Buffer preasignado para la duración máxima: el callback nunca reserva memoria
+    buf = np.empty(fs * max_segundos, dtype=np.int16)
+    n = 0
+
+    def callback(indata, frames, time, status):
+        # PortAudio entrega cada bloque en su propio buffer: se copia directo al nuestro
+        nonlocal n
+        if status:
+            print(status, file=sys.stderr)
+        k = min(frames, buf.size - n)
+        buf[n:n + k] = np.frombuffer(indata, dtype=np.int16)[:k]
+        n += k
+        if n == buf.size:
+            raise sd.CallbackStop
+
+    recording = sd.RawInputStream(samplerate=fs, channels=1, dtype='int16',
+                                  blocksize=1024, callback=callback)
 
     with recording:
-        while True:
+        while recording.active:
             if enter_presionado():  # si presionan ENTER, detener
                 sys.stdin.readline()  # limpiar buffer
                 break
 
-            audio_data.append(recording.read(1024)[0])
+            sd.sleep(50)
+        else:
+            print(f"Se alcanzó la duración máxima de {max_segundos} s")
 
-    data = np.concatenate(audio_data, axis=0)
+    data = buf[:n]
     wav.write(nombre, fs, data)
     print("Grabación detenida y guardada en", nombre)
+    return data
 
 
-# Grabar indefinidamente hasta que se presione ENTER nuevamente
-grabar_audio()
+# Grabar hasta que se presione ENTER nuevamente (o hasta la duración máxima)
+data = grabar_audio()
 
-# --- Transcribir ---
-with sr.AudioFile("temp.wav") as source:
-    audio = r.record(source)
+# --- Transcribir (desde memoria, sin volver a leer temp.wav) ---
+audio = sr.AudioData(data.tobytes(), 16000, 2)
 
 texto = r.recognize_google(audio, language="es-ES")
 print("Texto transcrito:", texto)
\ No newline at end of file
@@ -3,10 +3,23 @@ from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 import speech_recognition as sr
 import os
+import io
+import asyncio
+import functools
+import hashlib
+import shutil
+import subprocess
 import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import AsyncExitStack
 from pydub import AudioSegment
+import numpy as np
 import boto3
-import json
+import aioboto3
+import httpx
+from botocore.config import Config
+import orjson
 
 app = FastAPI(
     title="Audio AI API",
@@ -23,19 +36,344 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Inicializar reconocedor de voz
-recognizer = sr.Recognizer()
+# Google Speech API v2 (la misma que usa speech_recognition.recognize_google),
+# llamada directamente con un cliente HTTP/2 compartido cuando hay una clave
+# propia en GOOGLE_SPEECH_API_KEY; sin ella se usa recognize_google con la
+# clave por defecto de la librería
+_GOOGLE_STT_URL = "https://www.google.com/speech-api/v2/recognize"
+_GOOGLE_STT_KEY = os.getenv('GOOGLE_SPEECH_API_KEY')
+_GOOGLE_STT_PARAMS = {
+    "client": "chromium",
+    "lang": "es-ES",
+    "key": _GOOGLE_STT_KEY,
+    "pFilter": 0
+}
+google_client = None
 
-# Cliente de SageMaker
+# Binario de ffmpeg (None si no está instalado: se usa pydub como respaldo)
+_FFMPEG = shutil.which("ffmpeg")
+
+# Formato PCM al que se normaliza todo el audio (mono, 16 kHz, 16-bit)
+_SAMPLE_RATE = 16000
+_SAMPLE_WIDTH = 2
+
+# Audios largos se dividen en fragmentos de hasta 30 s que se transcriben en
+# paralelo; cada corte se hace en el tramo de 20 ms más silencioso de los
+# últimos 5 s del fragmento para no partir palabras
+_CHUNK_SECONDS = 30
+_CHUNK_BYTES = _CHUNK_SECONDS * _SAMPLE_RATE * _SAMPLE_WIDTH
+_SPLIT_SEARCH_SECONDS = 5
+_SPLIT_FRAME_SAMPLES = _SAMPLE_RATE // 50
+_TRANSCRIBE_CONCURRENCY = 4
+
+# Duración máxima del audio decodificado (el límite de bytes solo acota el archivo comprimido)
+MAX_AUDIO_SECONDS = int(os.getenv('MAX_AUDIO_SECONDS', 600))
+
+# Validación y lectura de los archivos de audio subidos
+_AUDIO_MIME_PREFIXES = ('audio/',)
+_UPLOAD_CHUNK_SIZE = 1 << 16
+MAX_AUDIO_BYTES = int(os.getenv('MAX_AUDIO_BYTES', 25 * 1024 * 1024))
+
+# Cachés LRU en memoria (por proceso): transcripciones por hash del audio
+# subido y respuestas del modelo por (endpoint, payload). CACHE_SIZE=0 las desactiva
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', 4096))
+_transcription_cache = OrderedDict()
+_model_cache = OrderedDict()
+_MISSING = object()
+
+# Campos habituales de respuesta del modelo, en orden de preferencia
+_SHORT_KEYS = ('response', 'answer', 'result', 'text', 'output', 'prediction')
+
+# Tamaño máximo (bytes UTF-8) de short_response para el buffer del display ESP32
+SHORT_RESPONSE_BYTES = 200
+
+# Cliente de SageMaker (pool de conexiones persistentes para reutilizar TLS)
+sagemaker_config = Config(
+    max_pool_connections=64,
+    tcp_keepalive=True,
+    retries={"max_attempts": 2, "mode": "standard"}
+)
+
+# Cliente asíncrono: se abre al arrancar la app y se reutiliza en cada request
+sagemaker_session = aioboto3.Session()
 sagemaker_runtime = None
-try:
-    sagemaker_runtime = boto3.client(
-        'sagemaker-runtime',
-        region_name=os.getenv('AWS_REGION', 'us-east-1')
+_exit_stack = AsyncExitStack()
+
+# Pool propio para trabajo bloqueante (ffmpeg, codificación FLAC), independiente
+# del executor por defecto que comparte uvicorn
+_EXECUTOR = None
+
+
+@app.on_event("startup")
+async def startup():
+    global sagemaker_runtime, _EXECUTOR
+    _EXECUTOR = ThreadPoolExecutor(
+        max_workers=min(32, (os.cpu_count() or 1) * 4),
+        thread_name_prefix="audio-worker"
+    )
+    _exit_stack.callback(_EXECUTOR.shutdown, wait=False)
+    
+    # Calentar ffmpeg para que el primer request no pague la carga del binario
+    if _FFMPEG:
+        await _run_blocking(
+            subprocess.run, [_FFMPEG, "-version"], capture_output=True
+        )
+    
+    _get_google_client()
+    
+    try:
+        sagemaker_runtime = await _exit_stack.enter_async_context(
+            sagemaker_session.client(
+                'sagemaker-runtime',
+                region_name=os.getenv('AWS_REGION', 'us-east-1'),
+                config=sagemaker_config
+            )
+        )
+        print("✓ SageMaker client inicializado correctamente")
+    except Exception as e:
+        print(f"⚠ SageMaker client no disponible: {e}")
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await _exit_stack.aclose()
+
+
+def _get_google_client() -> httpx.AsyncClient:
+    """Devuelve el cliente HTTP de Google, creándolo si el evento startup no se ejecutó"""
+    global google_client
+    if google_client is None:
+        google_client = httpx.AsyncClient(http2=True, timeout=30.0)
+        _exit_stack.push_async_callback(_close_google_client)
+    return google_client
+
+
+async def _close_google_client():
+    """Cierra el cliente HTTP de Google para que un nuevo arranque cree otro"""
+    global google_client
+    client, google_client = google_client, None
+    await client.aclose()
+
+
+async def _run_blocking(fn, *args, **kwargs):
+    """Ejecuta una función bloqueante en el pool de trabajo sin bloquear el event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_EXECUTOR, functools.partial(fn, *args, **kwargs))
+
+
+def _truncate(text: str, cap: int = SHORT_RESPONSE_BYTES) -> str:
+    """Recorta el texto a cap bytes UTF-8 (con "...") sin partir caracteres multibyte"""
+    encoded = text.encode('utf-8')
+    if len(encoded) <= cap:
+        return text
+    return encoded[:cap - 3].decode('utf-8', 'ignore') + "..."
+
+
+def _cache_get(cache: OrderedDict, key):
+    """Devuelve el valor cacheado (o _MISSING) y lo marca como usado recientemente"""
+    value = cache.get(key, _MISSING)
+    if value is not _MISSING:
+        cache.move_to_end(key)
+    return value
+
+
+def _cache_put(cache: OrderedDict, key, value) -> None:
+    """Guarda el valor descartando el menos usado si se supera CACHE_SIZE"""
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > CACHE_SIZE:
+        cache.popitem(last=False)
+
+
+async def _read_audio_upload(audio_file: UploadFile) -> bytearray:
+    """Valida el tipo de archivo y lee el audio por bloques con un límite de tamaño"""
+    if audio_file.content_type and not audio_file.content_type.startswith(_AUDIO_MIME_PREFIXES):
+        raise HTTPException(
+            status_code=400,
+            detail="El archivo debe ser de tipo audio"
+        )
+    
+    content = bytearray()
+    while chunk := await audio_file.read(_UPLOAD_CHUNK_SIZE):
+        if len(content) + len(chunk) > MAX_AUDIO_BYTES:
+            raise HTTPException(
+                status_code=413,
+                detail=f"El archivo de audio supera el tamaño máximo de {MAX_AUDIO_BYTES} bytes"
+            )
+        content += chunk
+    return content
+
+
+def _run_ffmpeg(source: str, content=None) -> subprocess.CompletedProcess:
+    """Decodifica source (pipe:0 o una ruta) a PCM crudo por stdout"""
+    return subprocess.run(
+        [_FFMPEG, "-loglevel", "error", "-i", source,
+         "-t", str(MAX_AUDIO_SECONDS + 1),
+         "-ac", "1", "-ar", str(_SAMPLE_RATE), "-acodec", "pcm_s16le",
+         "-f", "s16le", "pipe:1"],
+        input=content,
+        capture_output=True
     )
-    print("✓ SageMaker client inicializado correctamente")
-except Exception as e:
-    print(f"⚠ SageMaker client no disponible: {e}")
+
+
+def _decode_to_pcm(content: bytearray) -> bytes:
+    """Convierte el audio recibido a PCM crudo mono 16 kHz 16-bit (sin cabecera WAV)"""
+    if _FFMPEG:
+        proc = _run_ffmpeg("pipe:0", content)
+        if proc.returncode == 0:
+            return proc.stdout
+        
+        # stdin no admite seek: MP4/M4A/MOV con el atom moov al final (notas de
+        # voz de iOS, muchas grabaciones de móvil) necesitan leerse desde archivo
+        temp_path = None
+        try:
+            with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp") as temp_audio:
+                temp_audio.write(content)
+                temp_path = temp_audio.name
+            proc = _run_ffmpeg(temp_path)
+        finally:
+            if temp_path and os.path.exists(temp_path):
+                os.unlink(temp_path)
+        
+        if proc.returncode != 0:
+            raise HTTPException(
+                status_code=400,
+                detail=f"No se pudo decodificar el audio: {proc.stderr.decode(errors='replace').strip()}"
+            )
+        return proc.stdout
+
+    audio = AudioSegment.from_file(io.BytesIO(content))
+    audio = audio.set_channels(1).set_frame_rate(_SAMPLE_RATE).set_sample_width(_SAMPLE_WIDTH)
+    return audio.raw_data
+
+
+def _encode_flac(pcm) -> bytes:
+    """Codifica el PCM (bytes o memoryview) a FLAC, el formato que espera Google (bloqueante)"""
+    return sr.AudioData(bytes(pcm), _SAMPLE_RATE, _SAMPLE_WIDTH).get_flac_data()
+
+
+def _blocking_recognize_google(pcm) -> str:
+    """Transcribe con recognize_google y la clave por defecto de la librería (bloqueante)"""
+    audio_data = sr.AudioData(bytes(pcm), _SAMPLE_RATE, _SAMPLE_WIDTH)
+    return sr.Recognizer().recognize_google(audio_data, language="es-ES")
+
+
+def _parse_google_response(body: str) -> str:
+    """Extrae la mejor transcripción de la respuesta de Google (un JSON por línea)"""
+    for line in body.splitlines():
+        if not line:
+            continue
+        result = orjson.loads(line).get("result")
+        if not result:
+            continue
+        alternatives = result[0].get("alternative") or []
+        if alternatives and "transcript" in alternatives[0]:
+            return alternatives[0]["transcript"]
+    raise sr.UnknownValueError()
+
+
+async def _google_transcribe(pcm) -> str:
+    """Transcribe el PCM con la API de Google usando el cliente HTTP compartido"""
+    if not _GOOGLE_STT_KEY:
+        # Sin clave propia: speech_recognition aporta su clave por defecto
+        return await _run_blocking(_blocking_recognize_google, pcm)
+    
+    flac = await _run_blocking(_encode_flac, pcm)
+    try:
+        response = await _get_google_client().post(
+            _GOOGLE_STT_URL,
+            params=_GOOGLE_STT_PARAMS,
+            content=flac,
+            headers={"Content-Type": f"audio/x-flac; rate={_SAMPLE_RATE}"}
+        )
+        response.raise_for_status()
+    except httpx.HTTPError as e:
+        raise sr.RequestError(f"recognition request failed: {e}") from e
+    return _parse_google_response(response.text)
+
+
+async def _google_transcribe_chunk(pcm) -> str:
+    """Como _google_transcribe, pero un fragmento sin voz devuelve texto vacío"""
+    try:
+        return await _google_transcribe(pcm)
+    except sr.UnknownValueError:
+        return ""
+
+
+def _split_points(pcm: bytes) -> list:
+    """Offsets (en bytes) de corte: el tramo más silencioso antes de cada marca de 30 s"""
+    samples = np.frombuffer(pcm, dtype=np.int16)
+    chunk = _CHUNK_SECONDS * _SAMPLE_RATE
+    window = _SPLIT_SEARCH_SECONDS * _SAMPLE_RATE
+    cuts = [0]
+    while len(samples) - cuts[-1] > chunk:
+        end = cuts[-1] + chunk
+        start = end - window
+        frames = samples[start:end].astype(np.float32).reshape(-1, _SPLIT_FRAME_SAMPLES)
+        energy = np.square(frames).mean(axis=1)
+        cuts.append(start + int(energy.argmin()) * _SPLIT_FRAME_SAMPLES)
+    cuts.append(len(samples))
+    return [cut * _SAMPLE_WIDTH for cut in cuts]
+
+
+async def _transcribe(pcm: bytes) -> str:
+    """Transcribe el PCM en fragmentos concurrentes y concatena el texto en orden"""
+    if len(pcm) > MAX_AUDIO_SECONDS * _SAMPLE_RATE * _SAMPLE_WIDTH:
+        raise HTTPException(
+            status_code=413,
+            detail=f"El audio supera la duración máxima de {MAX_AUDIO_SECONDS} segundos"
+        )
+    if len(pcm) <= _CHUNK_BYTES:
+        return await _google_transcribe(pcm)
+    
+    # Limitar cuántos fragmentos de este audio se envían a Google a la vez
+    semaphore = asyncio.Semaphore(_TRANSCRIBE_CONCURRENCY)
+    
+    async def transcribe_chunk(chunk):
+        async with semaphore:
+            return await _google_transcribe_chunk(chunk)
+    
+    cuts = _split_points(pcm)
+    view = memoryview(pcm)
+    texts = await asyncio.gather(
+        *(transcribe_chunk(view[start:end]) for start, end in zip(cuts, cuts[1:]))
+    )
+    texto = " ".join(text for text in texts if text)
+    if not texto:
+        raise sr.UnknownValueError()
+    return texto
+
+
+async def _transcribe_upload(content: bytearray) -> str:
+    """Decodifica y transcribe el audio subido, reutilizando la caché si ya se procesó"""
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    texto = _cache_get(_transcription_cache, digest)
+    if texto is not _MISSING:
+        return texto
+    
+    pcm = await _run_blocking(_decode_to_pcm, content)
+    texto = await _transcribe(pcm)
+    _cache_put(_transcription_cache, digest, texto)
+    return texto
+
+
+async def _invoke_sagemaker(endpoint: str, payload: dict):
+    """Invoca el endpoint de SageMaker y devuelve la respuesta parseada (con caché)"""
+    request_body = orjson.dumps(payload)
+    cache_key = (endpoint, request_body)
+    result = _cache_get(_model_cache, cache_key)
+    if result is not _MISSING:
+        return result
+    
+    response = await sagemaker_runtime.invoke_endpoint(
+        EndpointName=endpoint,
+        ContentType='application/json',
+        Body=request_body
+    )
+    body = await response['Body'].read()
+    result = orjson.loads(body)
+    _cache_put(_model_cache, cache_key, result)
+    return result
 
 
 # Modelo para el request del segundo endpoint
@@ -76,32 +414,12 @@ async def audio_to_text(audio_file: UploadFile = File(...)):
             "text": "texto transcrito del audio"
         }
     """
-    temp_path = None
-    wav_path = None
-    
     try:
-        # Validar que sea un archivo de audio
-        if audio_file.content_type and not audio_file.content_type.startswith('audio/'):
-            raise HTTPException(
-                status_code=400,
-                detail="El archivo debe ser de tipo audio"
-            )
-        
-        # Guardar audio en archivo temporal
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp") as temp_audio:
-            content = await audio_file.read()
-            temp_audio.write(content)
-            temp_path = temp_audio.name
+        # Validar y leer el archivo de audio
+        content = await _read_audio_upload(audio_file)
         
-        # Convertir a WAV (formato compatible con speech_recognition)
-        audio = AudioSegment.from_file(temp_path)
-        wav_path = temp_path.replace('.tmp', '.wav')
-        audio.export(wav_path, format="wav")
-        
-        # Transcribir audio
-        with sr.AudioFile(wav_path) as source:
-            audio_data = recognizer.record(source)
-            texto = recognizer.recognize_google(audio_data, language="es-ES")
+        # Convertir a PCM y transcribir (o reutilizar la transcripción cacheada)
+        texto = await _transcribe_upload(content)
         
         return {
             "text": texto
@@ -117,17 +435,13 @@ async def audio_to_text(audio_file: UploadFile = File(...)):
             status_code=503,
             detail=f"Error en el servicio de transcripción: {str(e)}"
         )
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Error procesando el audio: {str(e)}"
         )
-    finally:
-        # Limpiar archivos temporales
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
-        if wav_path and os.path.exists(wav_path):
-            os.unlink(wav_path)
 
 
 @app.post("/api/text-to-model")
@@ -168,15 +482,8 @@ async def text_to_model(input_data: TextInput):
             "language": "es"
         }
         
-        # Invocar endpoint de SageMaker
-        response = sagemaker_runtime.invoke_endpoint(
-            EndpointName=endpoint,
-            ContentType='application/json',
-            Body=json.dumps(payload)
-        )
-        
-        # Leer y parsear respuesta
-        result = json.loads(response['Body'].read().decode())
+        # Invocar endpoint de SageMaker y parsear respuesta
+        result = await _invoke_sagemaker(endpoint, payload)
         
         return {
             "model_response": result
@@ -216,51 +523,30 @@ async def audio_to_model(audio_file: UploadFile = File(...)):
             "success": true,
             "transcription": "texto transcrito",
             "model_response": {...},  # Respuesta completa del modelo
-            "short_response": "...",   # Versión corta (max 200 chars) para ESP32
+            "short_response": "...",   # Versión corta (max 200 bytes UTF-8) para ESP32
             "filename": "audio.wav"
         }
     """
-    temp_path = None
-    wav_path = None
-    
     try:
         # ========== PASO 1: TRANSCRIBIR AUDIO ==========
         print(f"📝 Procesando audio: {audio_file.filename}")
         
-        # Validar tipo de archivo
-        if audio_file.content_type and not audio_file.content_type.startswith('audio/'):
-            raise HTTPException(
-                status_code=400,
-                detail="El archivo debe ser de tipo audio"
-            )
-        
-        # Guardar audio temporalmente
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".tmp") as temp_audio:
-            content = await audio_file.read()
-            temp_audio.write(content)
-            temp_path = temp_audio.name
+        # Validar y leer el archivo de audio
+        content = await _read_audio_upload(audio_file)
         
-        # Convertir a WAV
-        audio = AudioSegment.from_file(temp_path)
-        wav_path = temp_path.replace('.tmp', '.wav')
-        audio.export(wav_path, format="wav")
-        
-        # Transcribir
-        with sr.AudioFile(wav_path) as source:
-            audio_data = recognizer.record(source)
-            texto = recognizer.recognize_google(audio_data, language="es-ES")
+        # Convertir a PCM y transcribir (o reutilizar la transcripción cacheada)
+        texto = await _transcribe_upload(content)
         
         print(f"✓ Transcripción: {texto[:80]}...")
         
         # ========== PASO 2: ENVIAR AL MODELO ==========
         if not sagemaker_runtime:
             # Sin SageMaker: devolver solo transcripción
-            short_text = texto if len(texto) <= 200 else texto[:197] + "..."
             return {
                 "success": True,
                 "transcription": texto,
                 "model_response": None,
-                "short_response": short_text,
+                "short_response": _truncate(texto),
                 "filename": audio_file.filename,
                 "note": "SageMaker no configurado. Solo transcripción disponible."
             }
@@ -268,12 +554,11 @@ async def audio_to_model(audio_file: UploadFile = File(...)):
         # Obtener endpoint
         endpoint = os.getenv('SAGEMAKER_ENDPOINT_NAME')
         if not endpoint:
-            short_text = texto if len(texto) <= 200 else texto[:197] + "..."
             return {
                 "success": True,
                 "transcription": texto,
                 "model_response": None,
-                "short_response": short_text,
+                "short_response": _truncate(texto),
                 "filename": audio_file.filename,
                 "note": "Endpoint de SageMaker no configurado."
             }
@@ -286,38 +571,26 @@ async def audio_to_model(audio_file: UploadFile = File(...)):
         
         # Invocar SageMaker
         print(f"🤖 Enviando al modelo: {endpoint}")
-        response = sagemaker_runtime.invoke_endpoint(
-            EndpointName=endpoint,
-            ContentType='application/json',
-            Body=json.dumps(payload)
-        )
-        
-        # Parsear respuesta
-        model_result = json.loads(response['Body'].read().decode())
+        model_result = await _invoke_sagemaker(endpoint, payload)
         print(f"✓ Respuesta del modelo recibida")
         
         # ========== PASO 3: CREAR VERSIÓN CORTA PARA ESP32 ==========
-        short_text = ""
-        
         # Intentar extraer el texto más relevante
         if isinstance(model_result, dict):
             # Buscar campos comunes de respuesta
-            for key in ['response', 'answer', 'result', 'text', 'output', 'prediction']:
-                if key in model_result:
-                    short_text = str(model_result[key])
-                    break
+            short_text = next(
+                (str(model_result[key]) for key in _SHORT_KEYS if key in model_result),
+                ""
+            )
             
             # Si no encontramos, usar el primer valor
             if not short_text and model_result:
-                short_text = str(list(model_result.values())[0])
+                short_text = str(next(iter(model_result.values())))
         else:
             short_text = str(model_result)
         
-        # Limitar a 200 caracteres para displays pequeños (ESP32)
-        if len(short_text) > 200:
-            short_response = short_text[:197] + "..."
-        else:
-            short_response = short_text
+        # Limitar a 200 bytes para displays pequeños (ESP32)
+        short_response = _truncate(short_text)
         
         return {
             "success": True,
@@ -349,21 +622,27 @@ async def audio_to_model(audio_file: UploadFile = File(...)):
             status_code=500,
             detail=f"Error en el flujo completo: {str(e)}"
         )
-    finally:
-        # Limpiar archivos temporales
-        if temp_path and os.path.exists(temp_path):
-            os.unlink(temp_path)
-        if wav_path and os.path.exists(wav_path):
-            os.unlink(wav_path)
 
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
+    workers = int(os.getenv('WEB_CONCURRENCY', max(2, os.cpu_count() or 1)))
     print("\n" + "="*50)
     print("🎤 Audio AI API - Iniciando servidor")
     print("="*50)
     print(f"📍 Servidor: http://0.0.0.0:8000")
     print(f"📖 Docs: http://0.0.0.0:8000/docs")
+    print(f"⚙ Workers: {workers}")
     print("="*50 + "\n")
     
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    # Varios procesos (cada uno con su event loop) + uvloop/httptools;
+    # uvloop no está disponible en Windows
+    uvicorn.run(
+        "app:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools"
+    )
\ No newline at end of file